@@ -2,10 +2,130 @@ import functions_framework
 import logging
 import os
 import io
+import threading
 
 # NOTE: Do not add any top-level logic or heavy imports here.
 # The container must start and listen on port 8080 immediately.
 # All initialization must happen inside the function handler.
+# The only exception is the cheap environment check below.
+
+# --- Configuration ---
+REQUIRED_ENV_VARS = ("GCP_PROJECT_ID", "BQ_DATASET", "BQ_TABLE", "PRODUCT_IMAGES_BUCKET_NAME", "GOOGLE_API_KEY")
+_missing_env_vars = [name for name in REQUIRED_ENV_VARS if not os.environ.get(name)]
+if _missing_env_vars:
+    # Fail at container start, so a misconfigured deployment is rejected
+    # instead of failing on the first uploaded file.
+    raise RuntimeError(f"Missing required environment variables: {', '.join(_missing_env_vars)}")
+
+GCP_PROJECT_ID = os.environ["GCP_PROJECT_ID"]
+GCP_REGION = os.environ.get("GCP_REGION")
+BQ_DATASET = os.environ["BQ_DATASET"]
+BQ_TABLE = os.environ["BQ_TABLE"]
+TABLE_ID = f"{GCP_PROJECT_ID}.{BQ_DATASET}.{BQ_TABLE}"
+FAILED_BUCKET_NAME = os.environ.get("FAILED_BUCKET_NAME")
+PRODUCT_IMAGES_BUCKET_NAME = os.environ["PRODUCT_IMAGES_BUCKET_NAME"]
+GOOGLE_API_KEY = os.environ["GOOGLE_API_KEY"]
+# Number of products with Gemini requests in flight at once.
+ROW_CONCURRENCY = int(os.environ.get("ROW_CONCURRENCY", "8"))
+# Gemini requests rejected with one of these statuses (rate limits and
+# overloaded preview models) are retried up to GEMINI_MAX_ATTEMPTS times in
+# total, backing off exponentially but never waiting more than
+# GEMINI_MAX_RETRY_SECONDS, before the row is given its error value.
+GEMINI_RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+GEMINI_MAX_ATTEMPTS = 4
+GEMINI_RETRY_BASE_SECONDS = 2
+GEMINI_MAX_RETRY_SECONDS = 30
+# Optional bucket for persisting Gemini results across invocations.
+LLM_CACHE_BUCKET_NAME = os.environ.get("LLM_CACHE_BUCKET_NAME")
+# CSVs at least this large are parsed with pyarrow instead of the csv module.
+PYARROW_CSV_MIN_BYTES = 10 * 1024 * 1024
+# The CSV is downloaded in chunks of CSV_CHUNK_BYTES (the Storage default is
+# 40 MiB) and handed to the event loop CSV_READ_BATCH_ROWS rows at a time, so
+# rows are dispatched while the rest of the file is still downloading.
+CSV_CHUNK_BYTES = 1024 * 1024
+CSV_READ_BATCH_ROWS = 500
+# Finished rows are loaded into BigQuery every BQ_FLUSH_ROWS rows or
+# BQ_FLUSH_SECONDS, whichever comes first. Each flush is one load job, so the
+# interval stays coarse to respect the daily load-job quota per table.
+BQ_FLUSH_ROWS = 500
+BQ_FLUSH_SECONDS = 60
+
+# Clients are created on the first invocation and reused by later (warm)
+# invocations of the same instance. The heavy imports stay inside the getters.
+# Invocations can run concurrently on the worker's threads, so first use is
+# guarded by a lock. Async objects are kept per thread (see _thread_state).
+_clients = {}
+_clients_lock = threading.RLock()
+_thread_state = threading.local()
+
+
+def _get_google_auth():
+    """Returns the shared (credentials, authorized HTTP session) pair for the Storage and BigQuery clients."""
+    # A single pooled session keeps TLS connections alive across calls and
+    # invocations. The pool is sized for the concurrent uploads and cache
+    # lookups made from worker threads (requests defaults to 10 connections).
+    # The clients still need the credentials themselves: they read settings
+    # such as the universe domain from them, not from the session.
+    with _clients_lock:
+        if "http" not in _clients:
+            import google.auth
+            from google.auth.transport.requests import AuthorizedSession
+            from requests.adapters import HTTPAdapter
+            credentials, _ = google.auth.default(scopes=["https://www.googleapis.com/auth/cloud-platform"])
+            session = AuthorizedSession(credentials)
+            session.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=64))
+            _clients["credentials"] = credentials
+            _clients["http"] = session
+        return _clients["credentials"], _clients["http"]
+
+
+def _get_storage_client():
+    """Returns the shared Cloud Storage client, creating it on first use."""
+    with _clients_lock:
+        if "storage" not in _clients:
+            from google.cloud import storage
+            credentials, session = _get_google_auth()
+            _clients["storage"] = storage.Client(credentials=credentials, _http=session)
+        return _clients["storage"]
+
+
+def _get_bigquery_client():
+    """Returns the shared BigQuery client, creating it on first use."""
+    with _clients_lock:
+        if "bigquery" not in _clients:
+            from google.cloud import bigquery
+            credentials, session = _get_google_auth()
+            _clients["bigquery"] = bigquery.Client(credentials=credentials, _http=session)
+        return _clients["bigquery"]
+
+
+def _get_gemini_client(api_key):
+    """Returns this thread's HTTP client for the Gemini REST API, creating it on first use."""
+    # Calling the REST API directly avoids loading the google-generativeai SDK
+    # and its gRPC/protobuf stack at cold start.
+    # The client's connection pool belongs to the event loop it first runs on,
+    # so it is kept per thread alongside that thread's loop.
+    if not hasattr(_thread_state, "gemini"):
+        import httpx
+        _thread_state.gemini = httpx.AsyncClient(
+            base_url="https://generativelanguage.googleapis.com/v1beta/",
+            headers={"x-goog-api-key": api_key},
+            # Image generation can take well over httpx's 5 second default.
+            timeout=httpx.Timeout(300.0, connect=10.0),
+        )
+    return _thread_state.gemini
+
+
+def _get_event_loop():
+    """Returns this thread's asyncio event loop, creating it on first use."""
+    # Each worker thread runs its invocations on its own loop: a shared loop
+    # would raise "This event loop is already running" for concurrent
+    # invocations. Reusing the thread's loop, instead of asyncio.run() per
+    # invocation, keeps that thread's Gemini client usable on warm invocations.
+    if not hasattr(_thread_state, "event_loop"):
+        import asyncio
+        _thread_state.event_loop = asyncio.new_event_loop()
+    return _thread_state.event_loop
 
 @functions_framework.cloud_event
 def process_csv_and_generate_content(cloud_event):
@@ -19,43 +139,44 @@ def process_csv_and_generate_content(cloud_event):
 
     try:
         # 2. Lazy Import Heavy Dependencies
+        import asyncio
+        import base64
+        import contextlib
         import json
         import csv
+        import hashlib
+        import itertools
+        import random
         from datetime import datetime
         from google.cloud import bigquery
-        from google.cloud import storage
-        import google.generativeai as genai
-
-        # 3. Configuration
-        GCP_PROJECT_ID = os.environ.get("GCP_PROJECT_ID")
-        GCP_REGION = os.environ.get("GCP_REGION")
-        BQ_DATASET = os.environ.get("BQ_DATASET")
-        BQ_TABLE = os.environ.get("BQ_TABLE")
-        FAILED_BUCKET_NAME = os.environ.get("FAILED_BUCKET_NAME")
-        PRODUCT_IMAGES_BUCKET_NAME = os.environ.get("PRODUCT_IMAGES_BUCKET_NAME")
-        GOOGLE_API_KEY = os.environ.get("GOOGLE_API_KEY")
-
-        if not GOOGLE_API_KEY:
-            logging.error("Missing required environment variable: GOOGLE_API_KEY")
-            return
+        from google.api_core.exceptions import NotFound, PreconditionFailed
+        from google.cloud.storage.retry import DEFAULT_RETRY
 
-        # 4. Initialize Clients
-        storage_client = storage.Client()
-        bq_client = bigquery.Client()
-        genai.configure(api_key=GOOGLE_API_KEY)
+        # 3. Initialize Clients (reused across warm invocations)
+        storage_client = _get_storage_client()
+        bq_client = _get_bigquery_client()
 
-        # 5. Initialize Models
-        text_model = genai.GenerativeModel("models/gemini-3-pro-preview")
-        image_model = genai.GenerativeModel("models/gemini-3-pro-image-preview")
+        # 4. Initialize Models
+        gemini_client = _get_gemini_client(GOOGLE_API_KEY)
+        TEXT_MODEL = "models/gemini-3-pro-preview"
+        IMAGE_MODEL = "models/gemini-3-pro-image-preview"
 
-        # 6. Parse Cloud Event
+        # 5. Parse Cloud Event
         data = cloud_event.data
         bucket_name = data["bucket"]
         file_name = data["name"]
-        logging.info(f"Triggered by file: gs://{bucket_name}/{file_name}")
+        file_size = int(data.get("size") or 0)
+        source_file = f"gs://{bucket_name}/{file_name}"
+        logging.info(f"Triggered by file: {source_file}")
+
+        # Maps spaces to underscores when building image blob names.
+        slug_table = str.maketrans({" ": "_"})
 
-        def move_to_failed_bucket(bucket_name, file_name):
-            """Moves a file to the designated 'failed' bucket."""
+        def move_to_failed_bucket(bucket_name, file_name, loaded_rows=0):
+            """
+            Moves a file to the designated 'failed' bucket.
+            If some of its rows were already loaded, the moved object's loaded_rows metadata says how many.
+            """
             if not FAILED_BUCKET_NAME:
                 logging.error("FAILED_BUCKET_NAME environment variable not set. Cannot move file.")
                 return
@@ -64,114 +185,408 @@ def process_csv_and_generate_content(cloud_event):
             destination_bucket = storage_client.bucket(FAILED_BUCKET_NAME)
             source_blob = source_bucket.blob(file_name)
 
+            # Cloud Storage has no cross-bucket move: rename_blob() and move_blob()
+            # only work within one bucket, so a server-side copy plus delete is
+            # the cheapest option here. This path only runs for failed files.
             try:
                 destination_blob = source_bucket.copy_blob(source_blob, destination_bucket, file_name)
+                if loaded_rows:
+                    # Re-uploading the file as is would load these rows a second time.
+                    destination_blob.metadata = {"loaded_rows": str(loaded_rows), "source_file": source_file}
+                    destination_blob.patch()
                 source_blob.delete()
                 logging.info(f"Moved '{file_name}' to failed bucket: gs://{FAILED_BUCKET_NAME}/{destination_blob.name}")
             except Exception as e:
                 logging.error(f"Failed to move '{file_name}' to failed bucket: {e}", exc_info=True)
 
-        # 7. Process File
-        rows_to_insert = []
-        try:
-            bucket = storage_client.bucket(bucket_name)
-            blob = bucket.blob(file_name)
-            csv_content = blob.download_as_text(encoding="utf-8")
-            
-            reader = csv.reader(io.StringIO(csv_content))
+        def retry_delay(response, attempt):
+            """Returns the seconds to wait before retrying a rejected Gemini request."""
+            # Honor the server's Retry-After (in seconds) when it sends one.
             try:
-                header = next(reader)
-            except StopIteration:
+                delay = float(response.headers.get("Retry-After"))
+            except (TypeError, ValueError):
+                # Jitter keeps the rows that were throttled together from retrying together.
+                delay = GEMINI_RETRY_BASE_SECONDS * 2 ** (attempt - 1) * random.uniform(0.5, 1.0)
+            return min(max(delay, 0.0), GEMINI_MAX_RETRY_SECONDS)
+
+        async def generate_content(model, prompt):
+            """Calls the Gemini generateContent REST method and returns the parts of the first candidate."""
+            for attempt in range(1, GEMINI_MAX_ATTEMPTS + 1):
+                response = await gemini_client.post(
+                    f"{model}:generateContent",
+                    json={"contents": [{"parts": [{"text": prompt}]}]},
+                )
+                if response.status_code not in GEMINI_RETRY_STATUS_CODES or attempt == GEMINI_MAX_ATTEMPTS:
+                    break
+                delay = retry_delay(response, attempt)
+                logging.warning(
+                    f"{model} returned HTTP {response.status_code}, retrying in {delay:.1f}s "
+                    f"(attempt {attempt} of {GEMINI_MAX_ATTEMPTS})."
+                )
+                await asyncio.sleep(delay)
+            response.raise_for_status()
+            candidates = response.json().get("candidates") or []
+            if not candidates:
+                # No candidates means the prompt was blocked by the safety filters.
+                return []
+            return candidates[0].get("content", {}).get("parts", [])
+
+        async def cached_generation(kind, model, prompt, generate):
+            """
+            Returns the result of awaiting generate(), persisted in LLM_CACHE_BUCKET_NAME by model and prompt hash.
+            Falsy results are returned without being cached.
+            """
+            if not LLM_CACHE_BUCKET_NAME:
+                return await generate()
+
+            key = hashlib.sha256(f"{kind}:{model}:{prompt}".encode("utf-8")).hexdigest()
+            cache_blob = storage_client.bucket(LLM_CACHE_BUCKET_NAME).blob(f"llm-cache/{kind}/{key}")
+            try:
+                return await asyncio.to_thread(cache_blob.download_as_text, encoding="utf-8")
+            except NotFound:
+                pass
+            except Exception as e:
+                logging.warning(f"Could not read {kind} cache entry {key}: {e}")
+
+            result = await generate()
+            if result:
+                try:
+                    await asyncio.to_thread(cache_blob.upload_from_string, result, content_type="text/plain")
+                except Exception as e:
+                    logging.warning(f"Could not write {kind} cache entry {key}: {e}")
+            return result
+
+        async def generate_text(product_name, keywords):
+            """Generates the marketing copy for a product."""
+            try:
+                text_prompt = f"Write a short, exciting marketing description for a product named '{product_name}' that is '{keywords}'. The description should be one paragraph."
+
+                async def generate():
+                    parts = await generate_content(TEXT_MODEL, text_prompt)
+                    generated_text = "".join(part.get("text", "") for part in parts).strip()
+                    if not generated_text:
+                        raise ValueError("No text returned.")
+                    return generated_text
+
+                return await cached_generation("text", TEXT_MODEL, text_prompt, generate)
+            except Exception as e:
+                logging.error(f"Text generation failed for '{product_name}': {e}")
+                return "Error: Text generation failed."
+
+        async def generate_image(product_name, keywords):
+            """Generates a product image, uploads it to Storage and returns its public URL."""
+            try:
+                # Built from the CSV fields rather than the generated copy, so the
+                # image request does not have to wait for the text request.
+                image_prompt = f"A professional, high-resolution marketing photo, studio lighting, of: {product_name}, {keywords}"
+
+                async def generate():
+                    parts = await generate_content(IMAGE_MODEL, image_prompt)
+
+                    # The image comes back base64-encoded in an inlineData part,
+                    # possibly next to text parts.
+                    image_part = next((part["inlineData"] for part in parts if "inlineData" in part), None)
+                    if image_part:
+                        image_bytes = base64.b64decode(image_part["data"])
+                        # Content-addressed name: identical images share one object,
+                        # and an object never changes once written.
+                        image_hash = hashlib.sha256(image_bytes).hexdigest()[:16]
+                        image_blob_name = f"{product_name.translate(slug_table).lower()}_{image_hash}.png"
+
+                        image_bucket = storage_client.bucket(PRODUCT_IMAGES_BUCKET_NAME)
+                        image_blob = image_bucket.blob(image_blob_name)
+                        # Immutable objects can be cached by browsers and Google's edge for a year.
+                        image_blob.cache_control = "public, max-age=31536000, immutable"
+                        # The Storage client is blocking, so upload from a worker thread.
+                        # if_generation_match=0 only creates the object, which also makes retries safe.
+                        try:
+                            await asyncio.to_thread(
+                                image_blob.upload_from_string,
+                                image_bytes,
+                                content_type="image/png",
+                                if_generation_match=0,
+                                retry=DEFAULT_RETRY,
+                            )
+                        except PreconditionFailed:
+                            logging.info(f"Reusing existing image gs://{PRODUCT_IMAGES_BUCKET_NAME}/{image_blob_name}")
+
+                        return image_blob.public_url
+                    return None
+
+                # The cache stores the uploaded image's URL, so a hit skips both
+                # the Gemini call and the upload.
+                return await cached_generation("image", IMAGE_MODEL, image_prompt, generate) or "Error: No image returned."
+
+            except Exception as e:
+                 # Attempting fallback or catching differing structure errors
+                logging.error(f"Image generation failed for '{product_name}': {e}")
+                return "Error: Image generation failed."
+
+        def parse_row(row_number, row):
+            """Returns the (product_name, keywords) pair of a CSV row, or None if it should be skipped."""
+            if len(row) < 2: 
+                logging.warning(f"Skipping malformed row #{row_number} in '{file_name}': {row}")
+                return None
+
+            product_name = row[0].strip()
+            keywords = row[1].strip()
+
+            if not product_name and not keywords:
+                return None
+            return product_name, keywords
+
+        async def generate_for_product(product_name, keywords):
+            """Generates the (text, image URL) pair for one product."""
+            # Text and image requests are independent, so run them side by side.
+            generated_text, generated_image_url = await asyncio.gather(
+                generate_text(product_name, keywords),
+                generate_image(product_name, keywords),
+            )
+            # A card needs both, so an image without copy is not published.
+            if generated_text.startswith("Error:"):
+                generated_image_url = "Skipped: Text generation failed."
+            return generated_text, generated_image_url
+
+        def build_record(product_name, keywords, generated_text, generated_image_url):
+            """Builds the BigQuery record for a processed CSV row."""
+            return {
+                "product_name": product_name,
+                "keywords": keywords,
+                "generated_content": generated_text,
+                "generated_image_url": generated_image_url,
+                "source_file": source_file,
+                "processed_at": datetime.utcnow().isoformat()
+            }
+
+        def check_header(header):
+            """Raises ValueError unless the CSV header has product name and keywords columns."""
+            if not header:
                 raise ValueError(f"CSV file '{file_name}' is empty or has no header.")
+            if len(header) < 2:
+                raise ValueError(f"CSV file '{file_name}' needs product name and keywords columns, got header: {header}")
+
+        def read_csv_rows(blob):
+            """
+            Yields the data rows of a CSV blob, streamed from Storage.
+            Large files are parsed in C by pyarrow; small ones skip its import cost.
+            """
+            if file_size >= PYARROW_CSV_MIN_BYTES:
+                import pyarrow as pa
+                import pyarrow.csv as pcsv
+
+                with blob.open("rb", chunk_size=CSV_CHUNK_BYTES) as csv_file:
+                    # Read the header ourselves so it, not the first data row,
+                    # sets the column count pyarrow expects.
+                    header = next(csv.reader([csv_file.readline().decode("utf-8")]), [])
+                    check_header(header)
+                    if csv_file.tell() >= file_size:
+                        # Header-only file; pyarrow would reject the empty remainder.
+                        return
+
+                    # pyarrow rejects rows whose column count differs from the
+                    # header. Those are re-parsed with the csv module instead, so
+                    # parse_row() sees the same rows as on the csv path below.
+                    invalid_rows = []
 
-            for i, row in enumerate(reader):
-                if len(row) < 2: 
-                    logging.warning(f"Skipping malformed row #{i+2} in '{file_name}': {row}")
-                    continue
+                    def collect_invalid_row(invalid_row):
+                        invalid_rows.append(invalid_row.text)
+                        return "skip"
 
-                product_name = row[0].strip()
-                keywords = row[1].strip()
+                    def reparse_invalid_rows():
+                        texts = invalid_rows[:]
+                        del invalid_rows[:]
+                        for text in texts:
+                            yield next(csv.reader([text]), [])
 
-                if not product_name and not keywords:
-                    continue
+                    column_names = [f"f{i}" for i in range(len(header))]
+                    batches = pcsv.open_csv(
+                        csv_file,
+                        read_options=pcsv.ReadOptions(column_names=column_names),
+                        parse_options=pcsv.ParseOptions(invalid_row_handler=collect_invalid_row),
+                        convert_options=pcsv.ConvertOptions(
+                            include_columns=["f0", "f1"],
+                            column_types={"f0": pa.string(), "f1": pa.string()},
+                        ),
+                    )
+                    for batch in batches:
+                        yield from zip(batch.column(0).to_pylist(), batch.column(1).to_pylist())
+                        yield from reparse_invalid_rows()
+                    yield from reparse_invalid_rows()
+                return
+
+            with blob.open("rt", encoding="utf-8", newline="", chunk_size=CSV_CHUNK_BYTES) as csv_file:
+                reader = csv.reader(csv_file)
+                check_header(next(reader, []))
+                yield from reader
+
+        async def stream_csv_rows(blob):
+            """
+            Yields the rows of read_csv_rows() without blocking the event loop.
+            Batches are downloaded and parsed in a worker thread, one batch ahead
+            of the rows being dispatched.
+            """
+            rows = read_csv_rows(blob)
+
+            def read_batch():
+                return list(itertools.islice(rows, CSV_READ_BATCH_ROWS))
+
+            pending = asyncio.ensure_future(asyncio.to_thread(read_batch))
+            try:
+                while True:
+                    batch = await pending
+                    if not batch:
+                        return
+                    pending = asyncio.ensure_future(asyncio.to_thread(read_batch))
+                    for row in batch:
+                        yield row
+            finally:
+                # A read may still be running in its thread, and the generator
+                # can only be closed once it has returned.
+                await asyncio.gather(pending, return_exceptions=True)
+                rows.close()
 
-                generated_text = None
-                generated_image_url = None
+        def load_records(records):
+            """Appends records to the BigQuery table with a load job and returns the number of rows loaded."""
+            try:
+                # A load job from newline-delimited JSON avoids the streaming
+                # insertAll quotas and is free for batch ingestion.
+                ndjson = "\n".join(json.dumps(record) for record in records)
+                job_config = bigquery.LoadJobConfig(
+                    source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+                    write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+                )
+                load_job = bq_client.load_table_from_file(
+                    io.BytesIO(ndjson.encode("utf-8")), TABLE_ID, job_config=job_config
+                )
+                load_job.result()
+                logging.info(f"Loaded {load_job.output_rows} rows into BigQuery.")
+                return load_job.output_rows
+            except Exception as e:
+                logging.error(f"Failed to load {len(records)} rows into BigQuery: {e}")
+                return 0
 
-                # Generate Text
+        async def write_records(queue):
+            """
+            Loads records from the queue into BigQuery until it receives None.
+            Flushes every BQ_FLUSH_ROWS records or BQ_FLUSH_SECONDS, whichever comes first.
+            """
+            loop = asyncio.get_running_loop()
+            batch = []
+            loaded = 0
+            deadline = loop.time() + BQ_FLUSH_SECONDS
+            while True:
+                finished = False
                 try:
-                    text_prompt = f"Write a short, exciting marketing description for a product named '{product_name}' that is '{keywords}'. The description should be one paragraph."
-                    text_response = text_model.generate_content(text_prompt)
-                    generated_text = text_response.text.strip()
-                except Exception as e:
-                    logging.error(f"Text generation failed for '{product_name}': {e}")
-                    generated_text = "Error: Text generation failed."
-
-                # Generate Image
-                if generated_text and "Error:" not in generated_text:
-                    try:
-                        image_prompt = f"A professional, high-resolution marketing photo, studio lighting, of: {product_name}, {generated_text[:100]}"
-                        image_response = image_model.generate_content(image_prompt)
-                        
-                        # Assuming image response handling for saving
-                        # Note: The exact structure of image bytes in Gemini 3.0 preview might differ, 
-                        # adapting based on typical GenAI python client usage for images.
-                        # Usually it's in response.parts or similar if it returns bytes.
-                        # For the purpose of this task, assuming standard response structure or PIL Image.
-                        # If the client returns a PIL image (common in some genai versions), we save it.
-                        
-                        # NOTE: Verify actual response structure for Gemini 3 Image model in preview.
-                        # Often it returns an Image object in python client.
-                        
-                        if hasattr(image_response, 'parts') and image_response.parts:
-                             # Check for image data in parts
-                            image_bytes = image_response.parts[0].inline_data.data
-                            image_blob_name = f"{product_name.replace(' ', '_').lower()}_{int(datetime.utcnow().timestamp())}.png"
-                            
-                            image_bucket = storage_client.bucket(PRODUCT_IMAGES_BUCKET_NAME)
-                            image_blob = image_bucket.blob(image_blob_name)
-                            image_blob.upload_from_file(io.BytesIO(image_bytes), content_type="image/png")
-                            
-                            generated_image_url = image_blob.public_url
+                    record = await asyncio.wait_for(queue.get(), timeout=max(deadline - loop.time(), 0))
+                    if record is None:
+                        finished = True
+                    else:
+                        batch.append(record)
+                        if len(batch) < BQ_FLUSH_ROWS:
+                            continue
+                except asyncio.TimeoutError:
+                    pass
+
+                if batch:
+                    loaded += await asyncio.to_thread(load_records, batch)
+                    batch = []
+                if finished:
+                    return loaded
+                deadline = loop.time() + BQ_FLUSH_SECONDS
+
+        async def generate_rows(blob, queue):
+            """
+            Generates content for every row of the CSV blob and returns the number of rows.
+            Each row's BigQuery record is queued as soon as its content is ready.
+            """
+            semaphore = asyncio.Semaphore(ROW_CONCURRENCY)
+
+            # Duplicate (product_name, keywords) pairs share a single Gemini
+            # request; every CSV row still gets its own BigQuery record.
+            # Rows are dispatched while the rest of the file is still downloading.
+            generations = {}
+            waiting_rows = {}
+            results = {}
+            row_count = 0
+
+            async def generate_and_queue(key):
+                try:
+                    results[key] = await generate_for_product(*key)
+                finally:
+                    semaphore.release()
+                for _ in range(waiting_rows.pop(key)):
+                    queue.put_nowait(build_record(*key, *results[key]))
+
+            try:
+                async with contextlib.aclosing(stream_csv_rows(blob)) as rows:
+                    row_number = 1
+                    async for row in rows:
+                        row_number += 1
+                        key = parse_row(row_number, row)
+                        if key is None:
+                            continue
+                        row_count += 1
+                        if key in results:
+                            queue.put_nowait(build_record(*key, *results[key]))
+                        elif key in generations:
+                            waiting_rows[key] += 1
                         else:
-                            generated_image_url = "Error: No image returned."
-
-                    except Exception as e:
-                         # Attempting fallback or catching differing structure errors
-                        logging.error(f"Image generation failed for '{product_name}': {e}")
-                        generated_image_url = "Error: Image generation failed."
-                else:
-                    generated_image_url = "Skipped: Text generation failed."
-
-                rows_to_insert.append({
-                    "product_name": product_name,
-                    "keywords": keywords,
-                    "generated_content": generated_text,
-                    "generated_image_url": generated_image_url,
-                    "source_file": f"gs://{bucket_name}/{file_name}",
-                    "processed_at": datetime.utcnow().isoformat()
-                })
-
-            if not rows_to_insert:
+                            # Stop reading the file while ROW_CONCURRENCY products are
+                            # in flight, so pending tasks never pile up in memory.
+                            await semaphore.acquire()
+                            waiting_rows[key] = 1
+                            generations[key] = asyncio.create_task(generate_and_queue(key))
+                            # Let the new task send its requests before parsing the next row.
+                            await asyncio.sleep(0)
+            except BaseException:
+                # The loop outlives this invocation, so do not leave requests running on it.
+                for task in generations.values():
+                    task.cancel()
+                raise
+
+            await asyncio.gather(*generations.values())
+
+            if len(generations) < row_count:
+                logging.info(f"Reused generated content for {row_count - len(generations)} duplicate rows.")
+            return row_count
+
+        async def process_file(blob, progress):
+            """
+            Generates content for the CSV blob while a background writer loads finished rows into BigQuery.
+            The number of rows loaded is stored in progress["loaded_rows"], even if the file fails.
+            """
+            queue = asyncio.Queue()
+            writer = asyncio.create_task(write_records(queue))
+            try:
+                return await generate_rows(blob, queue)
+            finally:
+                # Load whatever finished, even if the file failed midway, so a
+                # timeout or bad row does not discard rows already generated.
+                queue.put_nowait(None)
+                progress["loaded_rows"] = await writer
+                logging.info(f"Loaded {progress['loaded_rows']} rows from '{file_name}' into BigQuery in total.")
+
+        # 6. Process File
+        progress = {"loaded_rows": 0}
+        try:
+            bucket = storage_client.bucket(bucket_name)
+            blob = bucket.blob(file_name)
+
+            row_count = _get_event_loop().run_until_complete(process_file(blob, progress))
+
+            if not row_count:
                  logging.warning(f"No valid rows processed in '{file_name}'.")
 
         except Exception as e:
             logging.error(f"Critical error processing '{file_name}': {e}", exc_info=True)
-            move_to_failed_bucket(bucket_name, file_name)
+            if progress["loaded_rows"]:
+                logging.error(
+                    f"'{file_name}' failed after {progress['loaded_rows']} of its rows were loaded into BigQuery "
+                    f"with source_file = '{source_file}'. Delete them before re-processing the file."
+                )
+            move_to_failed_bucket(bucket_name, file_name, progress["loaded_rows"])
             return
 
-        # 8. Save to BigQuery
-        if rows_to_insert:
-            try:
-                table_id = f"{GCP_PROJECT_ID}.{BQ_DATASET}.{BQ_TABLE}"
-                errors = bq_client.insert_rows_json(table_id, rows_to_insert)
-                if not errors:
-                    logging.info(f"Inserted {len(rows_to_insert)} rows into BigQuery.")
-                else:
-                    logging.error(f"BigQuery insertion errors: {errors}")
-            except Exception as e:
-                logging.error(f"Failed to insert into BigQuery: {e}")
-
     except Exception as e:
         logging.error(f"Fatal error in execution: {e}", exc_info=True)
 
@@ -1,47 +1,81 @@
 import streamlit as st
-from google.cloud import bigquery
 import os
+from datetime import datetime, timedelta, timezone
 
 # --- Configuration ---
 PROJECT_ID = os.environ.get("GCP_PROJECT_ID")
 DATASET_ID = os.environ.get("BQ_DATASET")
 TABLE_ID = os.environ.get("BQ_TABLE")
+TABLE_REF = f"`{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}`"
+# Only the most recent partitions are scanned; the table is partitioned by DATE(processed_at).
+WINDOW_DAYS = 7
+
+# Identifiers cannot be query parameters, so only the table reference is
+# formatted into the SQL; everything else is bound through QueryJobConfig.
+LATEST_QUERY = f"""
+    SELECT product_name, keywords, generated_content, generated_image_url
+    FROM {TABLE_REF}
+    WHERE processed_at >= @cutoff
+      AND generated_image_url IS NOT NULL 
+      AND NOT STARTS_WITH(generated_image_url, @error_prefix)
+      AND NOT STARTS_WITH(generated_content, @error_prefix)
+    ORDER BY processed_at DESC
+    LIMIT @limit
+"""
 
 st.set_page_config(page_title="AI Marketing Gallery", layout="wide")
 
 st.title("🛍️ AI Marketing Content Gallery")
-st.markdown(f"Displaying results from BigQuery table: `{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}`")
+st.markdown(f"Displaying results from BigQuery table: {TABLE_REF}")
+
+
+@st.cache_resource
+def get_bq_client():
+    """Returns a BigQuery client shared across reruns and sessions."""
+    from google.cloud import bigquery
+    return bigquery.Client()
+
+
+@st.cache_data(ttl=60, show_spinner=False)
+def fetch_latest(limit=20):
+    """Returns the latest generated results as a list of dicts, cached for 60 seconds."""
+    from google.cloud import bigquery
+
+    client = get_bq_client()
+    # CURRENT_TIMESTAMP() would make BigQuery skip its result cache, so the
+    # cutoff is computed here and rounded down to the hour to stay stable.
+    now = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    cutoff = now - timedelta(days=WINDOW_DAYS)
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[
+            bigquery.ScalarQueryParameter("error_prefix", "STRING", "Error"),
+            bigquery.ScalarQueryParameter("limit", "INT64", limit),
+            bigquery.ScalarQueryParameter("cutoff", "TIMESTAMP", cutoff),
+        ],
+        use_query_cache=True,
+    )
+    # Plain dicts are picklable, which st.cache_data requires.
+    return [dict(row.items()) for row in client.query(LATEST_QUERY, job_config=job_config).result()]
+
 
 if not PROJECT_ID or not DATASET_ID or not TABLE_ID:
     st.error("Missing environment variables. Please check your deployment.")
 else:
     try:
-        client = bigquery.Client()
-        
         # Query the latest 20 results
-        query = f"""
-            SELECT product_name, keywords, generated_content, generated_image_url
-            FROM `{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}`
-            WHERE generated_image_url IS NOT NULL 
-              AND generated_image_url NOT LIKE 'Error%'
-            ORDER BY processed_at DESC
-            LIMIT 20
-        """
-        
-        query_job = client.query(query)
-        results = query_job.result()
+        results = fetch_latest()
         
         cols = st.columns(3) # Create a grid layout
         
         for i, row in enumerate(results):
             with cols[i % 3]:
-                st.subheader(row.product_name)
-                if row.generated_image_url:
-                    st.image(row.generated_image_url, use_container_width=True)
+                st.subheader(row["product_name"])
+                if row["generated_image_url"]:
+                    st.image(row["generated_image_url"], use_container_width=True)
                 
-                st.markdown("**Keywords:** " + row.keywords)
+                st.markdown("**Keywords:** " + row["keywords"])
                 with st.expander("Read Marketing Copy"):
-                    st.write(row.generated_content)
+                    st.write(row["generated_content"])
                 st.divider()
                 
     except Exception as e: